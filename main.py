@@ -1,19 +1,171 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import altair as alt
 import matplotlib.pyplot as plt
 import seaborn as sns
 import plotly.graph_objects as go
+import plotly.io as pio
 from PIL import Image
+import io
+import os
+import time
+import pickle
+import logging
+import threading
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 # Titre de l'application
 st.title('Population, Housing and Social Housing in France')
 # Problématique
 st.markdown ("How do demographics, housing characteristics and social housing policies interact to influence the well-being of residents in a given region?")
 
+# ##############################################################################
+
+# Cache commun à toutes les sessions, découpé en niveaux (données, agrégats, figures,
+# images). Chaque niveau a un budget en octets et une durée de vie : les entrées les
+# moins récemment utilisées sont évincées dès que le budget est dépassé, ce qui garde
+# le processus dans une enveloppe mémoire fixe. Les compteurs hits / misses / evictions
+# sont affichés dans la barre latérale et écrits dans les logs.
+CACHE_TIERS = {
+    # niveau: (budget en octets, durée de vie en secondes)
+    "datasets": (64 * 1024 ** 2, 24 * 3600),
+    "aggregates": (32 * 1024 ** 2, 3600),
+    "figures": (32 * 1024 ** 2, 1800),
+    "images": (16 * 1024 ** 2, 3600),
+}
+
+
+# Estimation de la taille en mémoire d'une valeur mise en cache
+def size_of(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        size = value.memory_usage(deep=True)
+        return int(size.sum()) if isinstance(value, pd.DataFrame) else int(size)
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(size_of(item) for item in value)
+    return len(pickle.dumps(value))
+
+
+class CacheTier:
+    def __init__(self, name, max_bytes, ttl):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # clé -> (valeur, taille, date d'insertion)
+        self.current_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, value):
+        size = size_of(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                logger.warning("cache %s: entry of %d bytes exceeds the tier budget, not cached", self.name, size)
+                return
+            self.entries[key] = (value, size, time.monotonic())
+            self.current_bytes += size
+            # Éviction LRU jusqu'à revenir dans le budget
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+                logger.info("cache %s: evicted %s", self.name, oldest[0])
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def contains(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (self.ttl is None or time.monotonic() - entry[2] <= self.ttl)
+
+    def stats(self):
+        with self.lock:
+            return {"tier": self.name, "entries": len(self.entries), "bytes": self.current_bytes,
+                    "budget": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+# Un seul jeu de niveaux par processus, partagé par toutes les sessions
+@st.cache_resource(show_spinner=False)
+def cache_tiers():
+    return {name: CacheTier(name, max_bytes, ttl) for name, (max_bytes, ttl) in CACHE_TIERS.items()}
+
+
+# Décorateur : met en cache le résultat de la fonction dans le niveau demandé.
+# Les arguments doivent être hachables (tuples plutôt que listes).
+# Le même objet est partagé par toutes les sessions et par le thread de préchargement :
+# les résultats doivent être traités en lecture seule. Seul le niveau "datasets"
+# renvoie une copie, pour que le code de la page puisse modifier ses données ;
+# func.shared(...) donne l'objet partagé sans copie, pour une lecture seule.
+def cached(tier):
+    def decorator(func):
+        def shared(*args, **kwargs):
+            key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            entry = cache_tiers()[tier].get(key)
+            if entry is not None:
+                return entry[0]
+            value = func(*args, **kwargs)
+            cache_tiers()[tier].put(key, value)
+            return value
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            value = shared(*args, **kwargs)
+            if tier == "datasets" and isinstance(value, pd.DataFrame):
+                return value.copy()
+            return value
+        wrapper.shared = shared
+        return wrapper
+    return decorator
+
+
+# Figure mise en cache sous forme de JSON (Plotly ou Altair) dans le niveau "figures"
+def cached_figure(key, build):
+    entry = cache_tiers()["figures"].get(key)
+    if entry is None:
+        fig = build()
+        kind = "plotly" if isinstance(fig, go.Figure) else "altair"
+        cache_tiers()["figures"].put(key, (kind, fig.to_json()))
+        return fig
+    kind, fig_json = entry[0]
+    return pio.from_json(fig_json) if kind == "plotly" else alt.Chart.from_json(fig_json)
+
+
+# Affichage des compteurs du cache (les évictions sont déjà loggées au niveau INFO)
+def cache_report():
+    report = pd.DataFrame([tier.stats() for tier in cache_tiers().values()])
+    logger.debug("cache stats: %s", report.to_dict('records'))
+    return report
+
+# ##############################################################################
+
 # Fonction pour charger les données depuis mon fichier CSV local
-@st.cache_data
+@cached("datasets")
 def load_data(nrows):
     # Définition du nom des colonnes
     column_names = [
@@ -37,8 +189,458 @@ def load_data(nrows):
     return data
 
 
+# Colonnes exprimées en pourcentage (parts, taux, variations) : elles ne s'additionnent
+# pas et n'ont pas de taux de croissance annuel moyen
+PERCENTAGE_COLUMNS = [
+    "variation_de_la_population_sur_10_ans_en", "dont_contribution_du_solde_naturel_en",
+    "dont_contribution_du_solde_migratoire_en", "population_de_moins_de_20_ans", "population_de_60_ans_et_plus",
+    "taux_de_chomage_au_t4_en", "taux_de_pauvrete_en", "taux_de_logements_sociaux_en",
+    "taux_de_logements_vacants_en", "taux_de_logements_individuels_en",
+    "parc_social_taux_de_logements_vacants_en", "parc_social_taux_de_logements_individuels_en",
+    "parc_social_taux_de_logements_energivores_e_f_g_en",
+]
+
+
+# Filtrer les données selon l'année, la plage d'années ou la région
+def select_rows(data, year=None, years=None, region=None):
+    mask = pd.Series(True, index=data.index)
+    if year is not None:
+        mask &= data['annee_publication'] == year
+    if years is not None:
+        mask &= (data['annee_publication'] >= years[0]) & (data['annee_publication'] <= years[1])
+    if region is not None:
+        mask &= data['nom_region'] == region
+    return data[mask]
+
+
+# Calcul des histogrammes côté serveur : on n'envoie au navigateur que les barres
+# (une ligne par intervalle), quel que soit le nombre de lignes derrière l'histogramme.
+# Le cache est indexé par (colonnes, filtre, nombre d'intervalles).
+@cached("aggregates")
+def histogram_bins(columns, nbins, year=None, years=None, region=None):
+    columns = list(columns)
+    values = select_rows(load_data(10000), year, years, region)[columns].to_numpy(dtype=float)
+    finite = np.isfinite(values)
+
+    # Intervalles communs à toutes les colonnes pour pouvoir les comparer
+    if finite.any():
+        low, high = values[finite].min(), values[finite].max()
+    else:
+        low, high = 0.0, 1.0
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    edges = np.linspace(low, high, nbins + 1)
+
+    # Index de l'intervalle de chaque valeur, puis comptage de toutes les colonnes en une passe
+    bin_index = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, nbins - 1)
+    flat_index = bin_index + np.arange(len(columns)) * nbins
+    counts = np.bincount(flat_index[finite], minlength=len(columns) * nbins).reshape(len(columns), nbins)
+
+    return pd.DataFrame({
+        "variable": np.repeat(columns, nbins),
+        "bin_start": np.tile(edges[:-1], len(columns)),
+        "bin_end": np.tile(edges[1:], len(columns)),
+        "bin_centre": np.tile((edges[:-1] + edges[1:]) / 2, len(columns)),
+        "count": counts.ravel(),
+    })
+
+
+# Panel département × année précalculé en une seule passe vectorisée :
+# valeur, variation par rapport à l'année précédente (_delta), taux de croissance annuel
+# moyen depuis la première année renseignée de chaque colonne (_cagr) et rang du
+# département pour l'année (_rank). Les calculs se font sur la grille complète
+# département × année, pour qu'une année manquante ne soit pas sautée.
+# Le CAGR n'est calculé que pour les effectifs et niveaux strictement positifs
+# (NaN pour les colonnes en pourcentage).
+@cached("aggregates")
+def department_panel():
+    data = load_data(10000).dropna(subset=['annee_publication'])
+    indicators = data.select_dtypes('number').columns.drop(['annee_publication', 'code_region'])
+    data = data.set_index(['code_departement', 'annee_publication']).sort_index()
+    grid = pd.MultiIndex.from_product(data.index.levels, names=data.index.names)
+    values = data[indicators].reindex(grid)
+
+    by_department = values.groupby(level='code_departement')
+    years = pd.DataFrame(np.repeat(grid.get_level_values('annee_publication').to_numpy()[:, None], len(indicators), axis=1),
+                         index=grid, columns=indicators)
+    first_year = years.where(values.notna()).groupby(level='code_departement').transform('min')
+    elapsed = (years - first_year).where(lambda gap: gap > 0)
+
+    delta = by_department.diff()
+    first = by_department.transform('first')
+    levels = values.columns.difference(PERCENTAGE_COLUMNS)
+    positive = (values[levels] > 0) & (first[levels] > 0)
+    ratio = (values[levels] / first[levels]).where(positive)
+    cagr = (ratio.pow(1 / elapsed[levels]) - 1).where(elapsed[levels].notna()).reindex(columns=values.columns)
+    rank = values.groupby(level='annee_publication').rank(ascending=False, method='min')
+
+    # Retour aux seules lignes présentes dans les données
+    return pd.concat([
+        data[['nom_departement', 'nom_region']],
+        values,
+        delta.add_suffix('_delta'),
+        cagr.add_suffix('_cagr'),
+        rank.add_suffix('_rank'),
+    ], axis=1).loc[data.index]
+
+
+# Comparaison de deux années : alignement sur code_departement par l'index et
+# calcul des écarts de toutes les colonnes numériques en une seule opération.
+# Le résultat est mis en cache par couple d'années, changer d'indicateur ne coûte rien.
+@cached("aggregates")
+def year_comparison(first_year, second_year):
+    data = load_data(10000)
+    indicators = data.select_dtypes('number').columns.drop(['annee_publication', 'code_region'])
+    first = data[data['annee_publication'] == first_year].set_index('code_departement')
+    second = data[data['annee_publication'] == second_year].set_index('code_departement')
+
+    deltas = second[indicators] - first[indicators]
+    labels = second[['nom_departement', 'nom_region', 'geo_point_2d']].combine_first(
+        first[['nom_departement', 'nom_region', 'geo_point_2d']])
+    return labels.join(deltas)
+
+
+# Matrice de corrélation (Pearson ou Spearman) mise en cache par (colonnes, méthode, filtre).
+# pandas ignore les valeurs manquantes paire par paire.
+@cached("aggregates")
+def correlation_matrix(columns, method='pearson', year=None, years=None, region=None):
+    return select_rows(load_data(10000), year, years, region)[list(columns)].corr(method=method)
+
+
+# Droite de régression (moindres carrés) entre deux colonnes, avec intervalle de confiance
+# à 95 % de la pente par bootstrap. Tous les rééchantillonnages sont calculés en un seul
+# lot NumPy ; le résultat est mis en cache par (x, y, filtre).
+@cached("aggregates")
+def trendline(x, y, year=None, years=None, region=None, n_boot=1000):
+    pairs = select_rows(load_data(10000), year, years, region)[[x, y]].dropna().to_numpy(dtype=float)
+    if len(pairs) < 3 or np.ptp(pairs[:, 0]) == 0:
+        return None
+    xs, ys = pairs[:, 0], pairs[:, 1]
+    slope, intercept = np.polyfit(xs, ys, 1)
+    pearson = np.corrcoef(xs, ys)[0, 1]
+
+    # Bootstrap : une ligne de la matrice par rééchantillonnage
+    rng = np.random.default_rng(0)
+    samples = rng.integers(0, len(pairs), size=(n_boot, len(pairs)))
+    bx, by = xs[samples], ys[samples]
+    bx_centred = bx - bx.mean(axis=1, keepdims=True)
+    by_centred = by - by.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        boot_slopes = (bx_centred * by_centred).sum(axis=1) / (bx_centred ** 2).sum(axis=1)
+    low, high = np.nanpercentile(boot_slopes, [2.5, 97.5])
+
+    return {"slope": slope, "intercept": intercept, "pearson": pearson, "n": len(pairs),
+            "slope_low": low, "slope_high": high, "x_min": xs.min(), "x_max": xs.max()}
+
+
+# Ajout de la droite de régression sur un nuage de points Plotly
+def add_trendline(fig, x, y, **filters):
+    fit = trendline(x, y, **filters)
+    if fit is not None:
+        x_line = np.array([fit["x_min"], fit["x_max"]])
+        fig.add_trace(go.Scatter(x=x_line, y=fit["intercept"] + fit["slope"] * x_line,
+                                 mode='lines', name='OLS fit', line=dict(color='black', dash='dash')))
+    return fit
+
+
+# Texte résumant la régression sous le graphique
+def fit_caption(fit):
+    if fit is None:
+        return "Not enough data to fit a trendline."
+    return (f"Pearson r = {fit['pearson']:.2f} (n = {fit['n']}) — slope = {fit['slope']:.4g}, "
+            f"95% bootstrap CI [{fit['slope_low']:.4g}, {fit['slope_high']:.4g}]")
+
+
+# Rendu PNG de la matrice de corrélation Seaborn, mis en cache dans le niveau "images"
+@cached("images")
+def correlation_heatmap(columns, method):
+    fig = plt.figure(figsize=(12, 10))
+    sns.heatmap(correlation_matrix(columns, method), annot=True, cmap='coolwarm', linewidths=0.5)
+    plt.title('Correlation matrix')
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+# Hiérarchie région -> département -> commune
+# Les effectifs (habitants, logements, constructions, flux du parc social) s'additionnent
+# d'un niveau à l'autre. Les taux et moyennes sont pondérés par leur propre dénominateur
+# (RATE_WEIGHTS, le nombre d'habitants par défaut) et la densité est recalculée comme
+# habitants / surface, la surface étant habitants / densité.
+COUNT_COLUMNS = [
+    "nombre_d_habitants", "nombre_de_logements", "nombre_de_residences_principales",
+    "moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en", "construction",
+    "parc_social_nombre_de_logements", "parc_social_logements_mis_en_location",
+    "parc_social_logements_demolis", "parc_social_ventes_a_des_personnes_physiques",
+]
+RATE_WEIGHTS = {
+    "taux_de_logements_sociaux_en": "nombre_de_logements",
+    "taux_de_logements_vacants_en": "nombre_de_logements",
+    "taux_de_logements_individuels_en": "nombre_de_logements",
+    "parc_social_taux_de_logements_vacants_en": "parc_social_nombre_de_logements",
+    "parc_social_taux_de_logements_individuels_en": "parc_social_nombre_de_logements",
+    "parc_social_loyer_moyen_en_eur_m2_mois": "parc_social_nombre_de_logements",
+    "parc_social_age_moyen_du_parc_en_annees": "parc_social_nombre_de_logements",
+    "parc_social_taux_de_logements_energivores_e_f_g_en": "parc_social_nombre_de_logements",
+}
+# Un fichier de communes par département (communes/<code_departement>.csv), chargé
+# uniquement quand l'utilisateur descend dans ce département
+COMMUNES_DIRECTORY = 'communes'
+
+
+# Agrégation des indicateurs par groupe en une seule passe
+def aggregate_level(data, keys):
+    indicators = data.select_dtypes('number').columns.drop(['annee_publication', 'code_region'], errors='ignore')
+    sums = [col for col in indicators if col in COUNT_COLUMNS]
+    rates = [col for col in indicators if col not in sums and col != 'densite_de_population_au_km2']
+    groups = [data[key] for key in keys]
+
+    # Moyennes pondérées : chaque taux par son dénominateur, sur les lignes où les deux sont renseignés
+    weights = data[[RATE_WEIGHTS.get(col, 'nombre_d_habitants') for col in rates]].set_axis(rates, axis=1)
+    weights = weights.where(data[rates].notna())
+    weighted = data[rates].mul(weights).groupby(groups).sum()
+    covered = weights.groupby(groups).sum()
+
+    # Densité : total des habitants / total des surfaces
+    inhabitants = data['nombre_d_habitants'].where(data['densite_de_population_au_km2'] > 0)
+    area = inhabitants / data['densite_de_population_au_km2']
+    density = (inhabitants.groupby(groups).sum() / area.groupby(groups).sum().replace(0, np.nan)).rename('densite_de_population_au_km2')
+
+    return pd.concat([data.groupby(keys)[sums].sum(min_count=1), weighted / covered.replace(0, np.nan), density],
+                     axis=1)[indicators]
+
+
+# Index parent / enfants et agrégats précalculés pour chaque niveau
+@cached("aggregates")
+def territory_hierarchy():
+    data = load_data(10000).dropna(subset=['annee_publication', 'nom_region'])
+    departments = data.drop_duplicates('code_departement').set_index('code_departement')
+    return {
+        "children": departments.groupby('nom_region').groups,
+        "parent": departments['nom_region'].to_dict(),
+        "names": departments['nom_departement'].to_dict(),
+        "region": aggregate_level(data, ['nom_region', 'annee_publication']),
+        "department": data.set_index(['code_departement', 'annee_publication']).sort_index(),
+    }
+
+
+# Chargement paresseux des communes d'un département (None si la partition n'existe pas).
+# L'absence de fichier n'est pas mise en cache : une partition ajoutée ensuite est vue tout de suite.
+def load_communes(code_departement):
+    path = os.path.join(COMMUNES_DIRECTORY, f'{code_departement}.csv')
+    if not os.path.exists(path):
+        return None
+    return read_communes(path)
+
+
+@cached("datasets")
+def read_communes(path):
+    return pd.read_csv(path, sep=';', dtype={'code_departement': str, 'code_commune': str})
+
+
+# Export des données filtrées par morceaux : on lit le jeu de données partagé sans le
+# copier, et seules les lignes sélectionnées et les colonnes demandées sont copiées,
+# un morceau à la fois (geom exclue par défaut).
+EXPORT_CHUNK_ROWS = 5000
+
+
+def export_chunks(columns, years, regions=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    data = load_data.shared(10000)
+    mask = (data['annee_publication'] >= years[0]) & (data['annee_publication'] <= years[1])
+    if regions:
+        mask &= data['nom_region'].isin(regions)
+    positions = np.flatnonzero(mask.to_numpy())
+    column_positions = [data.columns.get_loc(col) for col in columns]
+    for start in range(0, len(positions), chunk_rows):
+        yield data.iloc[positions[start:start + chunk_rows], column_positions]
+
+
+# Écriture des morceaux en mémoire : lots CSV successifs ou groupes de lignes Parquet.
+# st.download_button garde de toute façon le fichier en mémoire, le pic est donc
+# d'environ la taille de l'export plus un morceau.
+def write_export(chunks, file_format):
+    output = io.BytesIO()
+    write_chunks(chunks, file_format, output)
+    return output.getvalue()
+
+
+def write_chunks(chunks, file_format, output):
+    if file_format == "CSV":
+        for index, chunk in enumerate(chunks):
+            output.write(chunk.to_csv(sep=';', index=False, header=index == 0).encode('utf-8'))
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+
+# Options des listes déroulantes "Select a region" et "Select a column", partagées
+# entre les widgets et le préchauffage (le premier élément est la valeur par défaut)
+def region_options(data):
+    return data['nom_region'].unique()
+
+
+def histogram_column_options(data):
+    return data.select_dtypes('number').columns
+
+
+# Histogramme du nombre d'habitants pour une année donnée
+def inhabitants_histogram(year):
+    bins = histogram_bins(("nombre_d_habitants",), 10, year=year)
+    return alt.Chart(bins).mark_bar().encode(
+        alt.X('bin_start:Q', bin='binned', title='nombre_d_habitants'),
+        alt.X2('bin_end:Q'),
+        alt.Y('count:Q', title='Fréquence')
+    ).properties(width=500)
+
+
+# Carte des départements pour une année donnée
+def france_map(year):
+    year_data = select_rows(load_data(10000), year=year)
+    fig = px.scatter_mapbox(year_data,
+                            lat=year_data['geo_point_2d'].str.split(',').str[0].astype(float),
+                            lon=year_data['geo_point_2d'].str.split(',').str[1].astype(float),
+                            hover_name="nom_departement", hover_data=["nombre_d_habitants"],
+                            title="Map of geographical coordinates",
+                            zoom=5)
+    fig.update_layout(mapbox_style="carto-positron")
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    return fig
+
+
+# Contributions des soldes naturel et migratoire par région pour une année donnée
+def growth_factors_figure(year):
+    growth_factors_data = select_rows(load_data(10000), year=year)[["nom_region", "dont_contribution_du_solde_naturel_en", "dont_contribution_du_solde_migratoire_en"]]
+    growth_factors_data.columns = ["Région", "Solde Naturel", "Solde Migratoire"]
+    grouped_growth_factors_data = growth_factors_data.groupby("Région").sum().reset_index()
+    return px.bar(grouped_growth_factors_data, x="Région", y=["Solde Naturel", "Solde Migratoire"],
+                  labels={"Région": "Nom de la Région"}, title="Contributions au Solde Naturel et au Solde Migratoire",
+                  barmode='group')  # Utilisation de barmode='group' pour afficher deux histogrammes côte à côte
+
+
+# Carte des logements pour une année donnée
+def housing_map(year):
+    year_data = select_rows(load_data(10000), year=year)
+    selected_columns = ["nombre_de_logements", "nombre_de_residences_principales",
+                        "taux_de_logements_sociaux_en", "taux_de_logements_vacants_en",
+                        "taux_de_logements_individuels_en"]
+    map_data = year_data[selected_columns].apply(pd.to_numeric)
+    map_data["Latitude"] = year_data['geo_point_2d'].str.split(',').str[0].astype(float)
+    map_data["Longitude"] = year_data['geo_point_2d'].str.split(',').str[1].astype(float)
+    fig = px.scatter_mapbox(map_data,
+                            lat="Latitude",
+                            lon="Longitude",
+                            color="nombre_de_logements",
+                            size="nombre_de_residences_principales",
+                            hover_data=["taux_de_logements_sociaux_en", "taux_de_logements_vacants_en", "taux_de_logements_individuels_en"],
+                            title="Carte des Données Sélectionnées",
+                            zoom=5)
+    fig.update_layout(mapbox_style="carto-positron")
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    return fig
+
+
+# Nuage de points habitants / logements pour une année donnée, avec sa droite de régression
+def dwellings_scatter(year):
+    scatter_fig = px.scatter(select_rows(load_data(10000), year=year), x='nombre_d_habitants', y='nombre_de_logements',
+                             labels={'nombre_d_habitants': 'Nombre d\'Habitants', 'nombre_de_logements': 'Nombre de Logements'},
+                             title=f'Scatter plot: Number of inhabitants vs. number of dwellings ({year})')
+    add_trendline(scatter_fig, 'nombre_d_habitants', 'nombre_de_logements', year=year)
+    return scatter_fig
+
+
+# Figures qui dépendent de l'année, par section : ce sont elles que l'on précharge.
+# "Social housing" et "Comparison" utilisent des plages ou des couples d'années, pas
+# l'année choisie. "Drill-down" dépend de l'année, mais aussi de l'indicateur et de la
+# région choisis ; ses barres sont lues dans les agrégats déjà en cache, on ne les
+# précharge donc pas.
+YEAR_FIGURES = {
+    "Introduction": {"inhabitants_histogram": inhabitants_histogram, "map_of_france": france_map},
+    "Population": {"growth_factors": growth_factors_figure},
+    "Housing": {"housing_map": housing_map, "dwellings_scatter": dwellings_scatter},
+}
+# Bornes de tous les curseurs d'années (et du préchargement)
+FIRST_YEAR, LAST_YEAR = 2018, 2022
+
+
+# Préchauffage : exécuté une seule fois par processus, au premier lancement du script,
+# il charge les données, calcule les agrégats et construit les figures de la vue par défaut
+# ("Introduction / Population frequency").
+@st.cache_resource(show_spinner=False)
+def warm_up():
+    data = load_data(10000)
+    department_panel()
+    year_comparison(FIRST_YEAR, LAST_YEAR)
+    # Histogramme personnalisé avec les valeurs par défaut des listes déroulantes
+    histogram_bins((histogram_column_options(data)[0],), 20, region=region_options(data)[0])
+    for name, build in YEAR_FIGURES["Introduction"].items():
+        cached_figure((name, FIRST_YEAR), functools.partial(build, FIRST_YEAR))
+    return True
+
+
+# Un seul thread de préchargement par processus, et l'ensemble des figures en cours
+@st.cache_resource(show_spinner=False)
+def prefetch_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch"), set(), threading.Lock()
+
+
+def build_figure(key, build):
+    _, pending, lock = prefetch_executor()
+    try:
+        if not cache_tiers()["figures"].contains(key):
+            cached_figure(key, build)
+    except Exception:
+        logger.exception("prefetch of %s failed", key)
+    finally:
+        with lock:
+            pending.discard(key)
+
+
+# Préchargement en arrière-plan des figures de la section ouverte pour les années
+# voisines (l'année choisie est construite par la page elle-même) : la prochaine
+# interaction est en général un hit.
+def prefetch(section, year):
+    executor, pending, lock = prefetch_executor()
+    for neighbour in (year - 1, year + 1):
+        if not FIRST_YEAR <= neighbour <= LAST_YEAR:
+            continue
+        for name, build in YEAR_FIGURES.get(section, {}).items():
+            key = (name, neighbour)
+            with lock:
+                if key in pending:
+                    continue
+                pending.add(key)
+            executor.submit(build_figure, key, functools.partial(build, neighbour))
+
+
+# Création d'un histogramme Plotly à partir des intervalles précalculés
+def histogram_figure(bins, title, **kwargs):
+    color = 'variable' if bins['variable'].nunique() > 1 else None
+    fig = px.bar(bins, x='bin_centre', y='count', color=color, barmode='group',
+                 hover_data=['bin_start', 'bin_end'], title=title, **kwargs)
+    fig.update_layout(bargap=0)
+    return fig
+
+
+# Image de la barre latérale, décodée une seule fois par processus
+@cached("images")
+def load_image(path):
+    return Image.open(path).copy()
+
+
+# Préchauffage du cache avant de servir la première page
+warm_up()
+
 with st.sidebar:
-    image = Image.open('log france.jpg')
+    image = load_image('log france.jpg')
     st.image(image)
     st.write("My link :")
     st.write("[Github](https://github.com/stve-the-sheep)")
@@ -51,7 +653,7 @@ data_load_state = st.text('Loading data...')
 data = load_data(10000)
 
 # Création d'une ligne horizontale pour choisir l'année
-selected_year = st.slider("Select a year", 2018, 2022)
+selected_year = st.slider("Select a year", FIRST_YEAR, LAST_YEAR)
 
 with st.expander("Explanation"):
     st.write("""
@@ -64,7 +666,10 @@ filtered_data = data[data['annee_publication'] == selected_year]
 filtered_data['population_entre_20_et_60'] = filtered_data['population_de_60_ans_et_plus']- filtered_data['population_de_moins_de_20_ans']
 
 # Création une case déroulante pour choisir la partie que vous souhaitez
-selected_chart_section = st.selectbox("Select a section", ["Introduction", "Population", "Housing", "Social housing", "Conclusion"])
+selected_chart_section = st.selectbox("Select a section", ["Introduction", "Population", "Housing", "Social housing", "Comparison", "Drill-down", "Conclusion"])
+
+# Préchargement des figures des années voisines pour la section ouverte
+prefetch(selected_chart_section, selected_year)
 
 # ##############################################################################
 
@@ -81,10 +686,7 @@ if selected_chart_section == "Introduction":
 
     if selected_chart_type == "Population frequency":
         st.subheader('Histogram of the number of inhabitants')
-        chart = alt.Chart(filtered_data).mark_bar().encode(
-            alt.X('nombre_d_habitants:Q', bin=True),
-            alt.Y('count():Q', title='Fréquence')
-        ).properties(width=500)
+        chart = cached_figure(("inhabitants_histogram", selected_year), lambda: inhabitants_histogram(selected_year))
         st.altair_chart(chart)
         
         
@@ -94,16 +696,14 @@ if selected_chart_section == "Introduction":
                      """)
         
         # Sélection de la région
-        selected_region = st.selectbox("Select a region", data['nom_region'].unique())
-
-        # Filtrer les données en fonction de la région sélectionnée
-        filtered_data = data[data['nom_region'] == selected_region]
+        selected_region = st.selectbox("Select a region", region_options(data))
 
-        # Sélection de la colonne à afficher dans l'histogramme
-        selected_column = st.selectbox("Select a column", data.columns)
+        # Sélection de la colonne numérique à afficher dans l'histogramme
+        selected_column = st.selectbox("Select a column", histogram_column_options(data))
 
-        # Créer l'histogramme
-        fig = px.histogram(filtered_data, x=selected_column, title=f'Histogramme of {selected_column} for {selected_region}')
+        # Créer l'histogramme à partir des intervalles calculés côté serveur
+        bins = histogram_bins((selected_column,), 20, region=selected_region)
+        fig = histogram_figure(bins, f'Histogramme of {selected_column} for {selected_region}')
 
         # Personnaliser l'axe des x
         fig.update_xaxes(title=selected_column)
@@ -126,14 +726,7 @@ if selected_chart_section == "Introduction":
         
 # Code pour afficher une carte Plotly Express en utilisant la colonne "geo_point_2d"
         st.subheader('Map of geographical coordinates')
-        fig = px.scatter_mapbox(filtered_data, 
-                            lat=filtered_data['geo_point_2d'].str.split(',').str[0].astype(float),
-                            lon=filtered_data['geo_point_2d'].str.split(',').str[1].astype(float),
-                            hover_name="nom_departement", hover_data=["nombre_d_habitants"],
-                            title="Map of geographical coordinates",
-                            zoom=5)
-        fig.update_layout(mapbox_style="carto-positron")
-        fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+        fig = cached_figure(("map_of_france", selected_year), lambda: france_map(selected_year))
         st.plotly_chart(fig)
         
         
@@ -216,17 +809,11 @@ if selected_chart_section == "Introduction":
             "parc_social_age_moyen_du_parc_en_annees", "parc_social_taux_de_logements_energivores_e_f_g_en"
         ]
 
-        # Création la matrice de corrélation
-        correlation_matrix = data[numeric_columns].corr()
-
-        # Définissions la taille de la figure
-        plt.figure(figsize=(15, 12))
+        # Choix de la méthode de corrélation
+        selected_method = st.radio("Select a correlation method", ["pearson", "spearman"], horizontal=True)
 
-        # Visualisation la matrice de corrélation
-        plt.figure(figsize=(12, 10))
-        sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm', linewidths=0.5)
-        plt.title('Correlation matrix')
-        st.pyplot(plt)
+        # Visualisation la matrice de corrélation, rendue une fois puis gardée en PNG
+        st.image(correlation_heatmap(tuple(numeric_columns), selected_method))
         
         
         with st.expander("Explanation"):
@@ -248,20 +835,8 @@ elif selected_chart_section == "Population":
         # Facteurs de croissance de la population
         st.subheader("Population growth factors")
 
-        # Sélection des colonnes pertinentes pour les facteurs de croissance
-        growth_factors_data = filtered_data[["nom_region", "dont_contribution_du_solde_naturel_en", "dont_contribution_du_solde_migratoire_en"]]
-
-        # Renommer les colonnes pour des noms plus conviviaux
-        growth_factors_data.columns = ["Région", "Solde Naturel", "Solde Migratoire"]
-
-        # Regrouper les données par région
-        grouped_growth_factors_data = growth_factors_data.groupby("Région").sum().reset_index()
-
-        # Création d'un graphique à barres empilées pour illustrer les contributions
-        fig_growth_factors = px.bar(grouped_growth_factors_data, x="Région", y=["Solde Naturel", "Solde Migratoire"],
-                                    labels={"Région": "Nom de la Région"}, title="Contributions au Solde Naturel et au Solde Migratoire",
-                                    barmode='group')  # Utilisation de barmode='group' pour afficher deux histogrammes côte à côte
-
+        # Graphique à barres des contributions par région (mis en cache par année)
+        fig_growth_factors = cached_figure(("growth_factors", selected_year), lambda: growth_factors_figure(selected_year))
         
         # Affichage du graphique
         st.plotly_chart(fig_growth_factors)
@@ -285,8 +860,10 @@ Let's take the example of Occitanie in 2018: we see a significant migratory bala
             labels={'nombre_de_residences_principales': 'Nombre de Résidences Principales', 'nombre_d_habitants': 'Nombre d\'Habitants'},
             title='Relationship between the number of main residences and the number of inhabitants'
         )
+        fit = add_trendline(fig, 'nombre_de_residences_principales', 'nombre_d_habitants')
         # Afficher le graphique
         st.plotly_chart(fig)
+        st.caption(fit_caption(fit))
         
         
         with st.expander("Explanation"):
@@ -295,7 +872,9 @@ Let's take the example of Occitanie in 2018: we see a significant migratory bala
                      """)
             
         fig1 = px.scatter(data, x="nombre_d_habitants", y="taux_de_chomage_au_t4_en", title="Scatter plot Population vs Unemployment rate")
+        fit = add_trendline(fig1, "nombre_d_habitants", "taux_de_chomage_au_t4_en")
         st.plotly_chart(fig1)
+        st.caption(fit_caption(fit))
         
         
         with st.expander("Explanation"):
@@ -306,7 +885,9 @@ Let's take the example of Occitanie in 2018: we see a significant migratory bala
         # Graphique de dispersion : Densité de population vs Taux de chômage
         st.subheader('Scatter plot: Population density vs Unemployment rate')
         fig1 = px.scatter(data, x="densite_de_population_au_km2", y="taux_de_chomage_au_t4_en", title="Population density vs Unemployment rate")
+        fit = add_trendline(fig1, "densite_de_population_au_km2", "taux_de_chomage_au_t4_en")
         st.plotly_chart(fig1)
+        st.caption(fit_caption(fit))
         
         
         with st.expander("Explanation"):
@@ -317,7 +898,9 @@ Let's take the example of Occitanie in 2018: we see a significant migratory bala
         # Graphique de dispersion : Densité de population vs Taux de pauvreté
         st.subheader('Graphique de dispersion : Densité de population vs Taux de pauvreté')
         fig2 = px.scatter(data, x="densite_de_population_au_km2", y="taux_de_pauvrete_en", title="Population density vs poverty rate")
+        fit = add_trendline(fig2, "densite_de_population_au_km2", "taux_de_pauvrete_en")
         st.plotly_chart(fig2)
+        st.caption(fit_caption(fit))
         
         
         with st.expander("Explanation"):
@@ -331,7 +914,8 @@ Let's take the example of Occitanie in 2018: we see a significant migratory bala
 
 # MAP 3
         # Remplace les valeurs NaN par 0 dans la colonne "nombre_de_residences_principales"
-        data['nombre_de_residences_principales'].fillna(0, inplace=True)
+        # (sans modifier le jeu de données partagé par le cache)
+        data = data.assign(nombre_de_residences_principales=data['nombre_de_residences_principales'].fillna(0))
 
         # Créer une carte Plotly Express avec les caractéristiques sélectionnées
         selected_columns = ["nombre_d_habitants", "densite_de_population_au_km2", "variation_de_la_population_sur_10_ans_en",
@@ -370,23 +954,40 @@ Let's take the example of Occitanie in 2018: we see a significant migratory bala
         st.subheader('Line graph')
                 
 # Ligne 1
-        selected_location = st.selectbox("Select a location", data["nom_departement"].unique())
-        filtered_data = data[data["nom_departement"] == selected_location]
-
-        st.subheader(f"Variation of the population for {selected_location}")
-        chart1 = alt.Chart(filtered_data).mark_line().encode(
+        # Comparaison de plusieurs départements à partir du panel précalculé
+        panel = department_panel()
+        selected_locations = st.multiselect("Select locations", data["nom_departement"].dropna().unique(),
+                                            default=data["nom_departement"].iloc[:1].tolist())
+        selected_measure = st.selectbox("Select a measure", ["Value", "Year-over-year change", "Annual growth rate (CAGR)", "Rank"])
+        suffix = {"Value": "", "Year-over-year change": "_delta",
+                  "Annual growth rate (CAGR)": "_cagr", "Rank": "_rank"}[selected_measure]
+
+        # Lecture d'une tranche du panel, sans refiltrer les données brutes
+        population_column = "variation_de_la_population_sur_10_ans_en" + suffix
+        construction_column = "moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en" + suffix
+        panel_slice = panel.loc[panel["nom_departement"].isin(selected_locations),
+                                ["nom_departement", population_column, construction_column]].reset_index()
+        panel_slice["annee_publication"] = panel_slice["annee_publication"].astype(int).astype(str)
+        location_title = ", ".join(selected_locations)
+        if suffix == "_cagr":
+            st.info("The annual growth rate is only defined for counts and levels, not for percentages such as the population variation.")
+
+        st.subheader(f"Variation of the population for {location_title}")
+        chart1 = alt.Chart(panel_slice).mark_line().encode(
             x="annee_publication:T",
-            y="variation_de_la_population_sur_10_ans_en:Q",
-            tooltip=["annee_publication:T", "variation_de_la_population_sur_10_ans_en:Q"]
+            y=f"{population_column}:Q",
+            color="nom_departement:N",
+            tooltip=["nom_departement:N", "annee_publication:T", f"{population_column}:Q"]
         ).properties(width=600, height=300)
         st.altair_chart(chart1)
 
 # Ligne 2
-        st.subheader(f"Average annual new build for {selected_location}")
-        chart2 = alt.Chart(filtered_data).mark_line().encode(
+        st.subheader(f"Average annual new build for {location_title}")
+        chart2 = alt.Chart(panel_slice).mark_line().encode(
             x="annee_publication:T",
-            y="moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en:Q",
-            tooltip=["annee_publication:T", "moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en:Q"]
+            y=f"{construction_column}:Q",
+            color="nom_departement:N",
+            tooltip=["nom_departement:N", "annee_publication:T", f"{construction_column}:Q"]
         ).properties(width=600, height=300)
 
         st.altair_chart(chart2)
@@ -444,13 +1045,13 @@ elif selected_chart_section == "Housing":
 
 #Histogramme
         # Sélection d'une région
-        selected_region = st.selectbox("Select a region", data['nom_region'].unique())
+        selected_region = st.selectbox("Select a region", region_options(data))
 
         # Filtrer les données en fonction de la région sélectionnée
         filtered_data = data[data['nom_region'] == selected_region]
 
         # Création d'une ligne choisir les années
-        selected_years = st.slider("Select a year range", 2018, 2022, (2018, 2022))
+        selected_years = st.slider("Select a year range", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
 
         # Filtrer les données en fonction de la plage d'années sélectionnée
         filtered_data = filtered_data[(filtered_data['annee_publication'] >= selected_years[0]) & (filtered_data['annee_publication'] <= selected_years[1])]
@@ -499,25 +1100,8 @@ elif selected_chart_section == "Housing":
     elif selected_chart_type == "Geographical Distribution":
         
 # MAP 2
-        # Code pour afficher une carte Plotly Express avec toutes les caractéristiques sélectionnées
-        selected_columns = ["nombre_de_logements", "nombre_de_residences_principales",
-                            "taux_de_logements_sociaux_en", "taux_de_logements_vacants_en",
-                            "taux_de_logements_individuels_en"]
-        map_data = filtered_data[selected_columns]
-        map_data["Latitude"] = filtered_data['geo_point_2d'].str.split(',').str[0].astype(float)
-        map_data["Longitude"] = filtered_data['geo_point_2d'].str.split(',').str[1].astype(float)
-        for col in selected_columns:
-            map_data[col] = pd.to_numeric(map_data[col])
-        fig = px.scatter_mapbox(map_data,
-                                lat="Latitude",
-                                lon="Longitude",
-                                color="nombre_de_logements",
-                                size="nombre_de_residences_principales",
-                                hover_data=["taux_de_logements_sociaux_en", "taux_de_logements_vacants_en", "taux_de_logements_individuels_en"],
-                                title="Carte des Données Sélectionnées",
-                                zoom=5)
-        fig.update_layout(mapbox_style="carto-positron")
-        fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+        # Carte Plotly Express avec toutes les caractéristiques sélectionnées (mise en cache par année)
+        fig = cached_figure(("housing_map", selected_year), lambda: housing_map(selected_year))
         st.plotly_chart(fig)
 
 
@@ -534,11 +1118,10 @@ It is interesting to note that France's major cities, such as Paris, Marseille,
         filtered_data = data[data['annee_publication'] == selected_year]
         # Création d'un nuage de points en fonction de l'année sélectionnée
         
-        scatter_fig = px.scatter(filtered_data, x='nombre_d_habitants', y='nombre_de_logements',
-                                 labels={'nombre_d_habitants': 'Nombre d\'Habitants', 'nombre_de_logements': 'Nombre de Logements'},
-                                 title=f'Scatter plot: Number of inhabitants vs. number of dwellings ({selected_year})')
+        scatter_fig = cached_figure(("dwellings_scatter", selected_year), lambda: dwellings_scatter(selected_year))
         # Affichage du nuage de points
         st.plotly_chart(scatter_fig)
+        st.caption(fit_caption(trendline('nombre_d_habitants', 'nombre_de_logements', year=selected_year)))
 
         
         with st.expander("Explanation"):
@@ -570,7 +1153,9 @@ It is interesting to note that France's major cities, such as Paris, Marseille,
                               labels={'moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en': 'Construction Neuve Moyenne (10 ans)',
                                       'population_de_moins_de_20_ans': 'Moins de 20 ans'},
                               title=f'New Build vs Population Under 20 ({selected_year})')
+            fit = add_trendline(fig1, 'moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en', 'population_de_moins_de_20_ans', year=selected_year)
             st.plotly_chart(fig1)
+            st.caption(fit_caption(fit))
 
             
         with st.expander("Explanation"):
@@ -585,7 +1170,9 @@ It is interesting to note that France's major cities, such as Paris, Marseille,
                               labels={'moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en': 'Construction Neuve Moyenne (10 ans)',
                                       'population_de_60_ans_et_plus': '60 ans et plus'},
                               title=f'New build vs Population aged 60 and over ({selected_year})')
+            fit = add_trendline(fig2, 'moyenne_annuelle_de_la_construction_neuve_sur_10_ans_en', 'population_de_60_ans_et_plus', year=selected_year)
             st.plotly_chart(fig2)
+            st.caption(fit_caption(fit))
 
 
         with st.expander("Explanation"):
@@ -595,7 +1182,7 @@ It is interesting to note that France's major cities, such as Paris, Marseille,
             
             
 # ###############
-        selected_years = st.slider("Select a year range", 2018, 2022, (2018, 2022))
+        selected_years = st.slider("Select a year range", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
 
             # Filtrer les données en fonction de la plage d'années sélectionnée
         filtered_data = data[(data['annee_publication'] >= selected_years[0]) & (data['annee_publication'] <= selected_years[1])]
@@ -606,7 +1193,9 @@ It is interesting to note that France's major cities, such as Paris, Marseille,
             # Créer le premier graphique
         st.subheader("Number of inhabitants vs. construction")
         fig1 = px.scatter(filtered_data, x="construction", y="nombre_d_habitants", title="Number of inhabitants vs. construction")
+        fit = add_trendline(fig1, "construction", "nombre_d_habitants", years=selected_years)
         st.plotly_chart(fig1)
+        st.caption(fit_caption(fit))
 
             
         with st.expander("Explanation"):
@@ -618,7 +1207,9 @@ It is interesting to note that France's major cities, such as Paris, Marseille,
             # Créer le deuxième graphique
         st.subheader("Population density vs. construction")
         fig2 = px.scatter(filtered_data, x="construction", y="densite_de_population_au_km2", title="Population density vs. construction")
+        fit = add_trendline(fig2, "construction", "densite_de_population_au_km2", years=selected_years)
         st.plotly_chart(fig2)
+        st.caption(fit_caption(fit))
 
             
         with st.expander("Explanation"):
@@ -638,16 +1229,14 @@ elif selected_chart_section == "Social housing":
 
     if selected_chart_type == "Social Housing Statistics":
         
-        selected_years = st.slider("Select a year range", 2018, 2022, (2018, 2022))
-        # Filtrer les données en fonction de la plage d'années sélectionnée
-        filtered_data = data[(data['annee_publication'] >= selected_years[0]) & (data['annee_publication'] <= selected_years[1])]
+        selected_years = st.slider("Select a year range", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
 
         # Variables à inclure dans l'histogramme
-        variables = ["parc_social_nombre_de_logements", "parc_social_logements_mis_en_location", "parc_social_logements_demolis"]
+        variables = ("parc_social_nombre_de_logements", "parc_social_logements_mis_en_location", "parc_social_logements_demolis")
 
-        # Créer un histogramme pour les trois variables sur le même graphique
-        hist_fig = px.histogram(filtered_data, x=variables, title="Histogram of Social Housing Parameters")
-        hist_fig.update_layout(barmode='group')  # Superpose les histogrammes
+        # Créer un histogramme pour les trois variables sur le même graphique (intervalles communs)
+        bins = histogram_bins(variables, 20, years=selected_years)
+        hist_fig = histogram_figure(bins, "Histogram of Social Housing Parameters")
 
         # Afficher le graphique
         st.plotly_chart(hist_fig)
@@ -661,13 +1250,10 @@ elif selected_chart_section == "Social housing":
             
 # ###################
         
-        selected_region = st.selectbox("Select a region", data['nom_region'].unique())
-
-        # Filtrer les données en fonction de la région sélectionnée
-        filtered_data = data[data['nom_region'] == selected_region]
+        selected_region = st.selectbox("Select a region", region_options(data))
 
-        fig = px.histogram(filtered_data, x='parc_social_age_moyen_du_parc_en_annees',
-                           title=f"Histogram of the average age of the social housing stock for {selected_region}")
+        bins = histogram_bins(("parc_social_age_moyen_du_parc_en_annees",), 20, region=selected_region)
+        fig = histogram_figure(bins, f"Histogram of the average age of the social housing stock for {selected_region}")
 
         fig.update_xaxes(title="Average age of social housing stock in years")
 
@@ -687,7 +1273,7 @@ elif selected_chart_section == "Social housing":
     elif selected_chart_type == "Impact on the Population":
         
         # Filtrer les données en fonction de la plage d'années sélectionnée
-        selected_years = st.slider("Select a year range", 2018, 2022, (2018, 2022))
+        selected_years = st.slider("Select a year range", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
         filtered_data = data[(data['annee_publication'] >= selected_years[0]) & (data['annee_publication'] <= selected_years[1])]
 
         # Graphique de dispersion : Relation entre le nombre de logements sociaux et la densité de population
@@ -695,7 +1281,9 @@ elif selected_chart_section == "Social housing":
                                  labels={'densite_de_population_au_km2': 'Densité de Population au km2', 
                                          'parc_social_nombre_de_logements': 'Nombre de Logements Sociaux'},
                                  title='Relationship between social housing and population density')
+        fit = add_trendline(scatter_fig, 'densite_de_population_au_km2', 'parc_social_nombre_de_logements', years=selected_years)
         st.plotly_chart(scatter_fig)
+        st.caption(fit_caption(fit))
 
         
         with st.expander("Explanation"):
@@ -705,10 +1293,10 @@ elif selected_chart_section == "Social housing":
             
             
         # Histogramme : Distribution des taux de logements sociaux
-        histogram_fig = px.histogram(filtered_data, x='taux_de_logements_sociaux_en', nbins=20, 
-                                     labels={'taux_de_logements_sociaux_en': 'Taux de Logements Sociaux', 
-                                             'count': 'Nombre de Régions'},
-                                     title='Distribution of social housing rates')
+        bins = histogram_bins(("taux_de_logements_sociaux_en",), 20, years=selected_years)
+        histogram_fig = histogram_figure(bins, 'Distribution of social housing rates',
+                                         labels={'bin_centre': 'Taux de Logements Sociaux',
+                                                 'count': 'Nombre de Régions'})
         st.plotly_chart(histogram_fig)
 
         
@@ -752,10 +1340,14 @@ elif selected_chart_section == "Social housing":
                      """)    
         
         # Corrélation entre le nombre de logements sociaux et d'autres paramètres
-        correlation_matrix = filtered_data[['parc_social_nombre_de_logements', 'taux_de_chomage_au_t4_en', 'taux_de_pauvrete_en']].corr()
-        heatmap_fig = go.Figure(data=go.Heatmap(z=correlation_matrix.values,
-                                                x=correlation_matrix.columns,
-                                                y=correlation_matrix.columns,
+        selected_method = st.radio("Select a correlation method", ["pearson", "spearman"], horizontal=True)
+        matrix = correlation_matrix(('parc_social_nombre_de_logements', 'taux_de_chomage_au_t4_en', 'taux_de_pauvrete_en'),
+                                    selected_method, years=selected_years)
+        heatmap_fig = go.Figure(data=go.Heatmap(z=matrix.values,
+                                                x=matrix.columns,
+                                                y=matrix.columns,
+                                                text=matrix.round(2).values,
+                                                texttemplate='%{text}',
                                                 colorscale='Viridis'))
         heatmap_fig.update_layout(title='Correlation matrix')
         st.plotly_chart(heatmap_fig)
@@ -771,7 +1363,7 @@ elif selected_chart_section == "Social housing":
 
     elif selected_chart_type == "Social Housing Policies":
         # Filtrer les données en fonction de la plage d'années sélectionnée
-        selected_years = st.slider("Select a year range", 2018, 2022, (2018, 2022))
+        selected_years = st.slider("Select a year range", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
         filtered_data = data[(data['annee_publication'] >= selected_years[0]) & (data['annee_publication'] <= selected_years[1])]
 
         # Sélection les variables d'intérêt
@@ -793,6 +1385,123 @@ elif selected_chart_section == "Social housing":
             
 # ##############################################################################
 
+# Partie 4
+elif selected_chart_section == "Comparison":
+    st.subheader("Comparison between two years")
+
+    # Choix des deux années à comparer
+    first_year, second_year = st.slider("Select the two years to compare", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
+    comparison = year_comparison(first_year, second_year)
+
+    # Choix de l'indicateur et du nombre de départements à afficher
+    key_indicators = ["taux_de_chomage_au_t4_en", "taux_de_logements_vacants_en",
+                      "taux_de_logements_sociaux_en", "parc_social_loyer_moyen_en_eur_m2_mois"]
+    other_indicators = [col for col in comparison.select_dtypes('number').columns if col not in key_indicators]
+    selected_metric = st.selectbox("Select an indicator", key_indicators + other_indicators)
+    top_k = st.slider("Number of departments", 5, 20, 10)
+
+# #######################################
+
+    # Classement des départements qui ont le plus augmenté et le plus baissé
+    ranked = comparison[['nom_departement', 'nom_region', selected_metric]].dropna(subset=[selected_metric])
+    top_bottom = pd.concat([ranked.nlargest(top_k, selected_metric), ranked.nsmallest(top_k, selected_metric)]).drop_duplicates()
+
+    fig = px.bar(top_bottom.sort_values(selected_metric), x=selected_metric, y='nom_departement', color='nom_region',
+                 orientation='h', title=f'Largest changes in {selected_metric} between {first_year} and {second_year}')
+    fig.update_xaxes(title=f'Change ({second_year} - {first_year})')
+    fig.update_yaxes(title=None)
+    st.plotly_chart(fig)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("Largest increases")
+        st.dataframe(ranked.nlargest(top_k, selected_metric))
+    with col2:
+        st.write("Largest decreases")
+        st.dataframe(ranked.nsmallest(top_k, selected_metric))
+
+# #######################################
+
+    # Carte des écarts entre les deux années
+    map_data = comparison.dropna(subset=['geo_point_2d', selected_metric])
+    fig = px.scatter_mapbox(map_data,
+                            lat=map_data['geo_point_2d'].str.split(',').str[0].astype(float),
+                            lon=map_data['geo_point_2d'].str.split(',').str[1].astype(float),
+                            color=selected_metric,
+                            hover_name="nom_departement",
+                            color_continuous_scale='RdBu_r',
+                            color_continuous_midpoint=0,
+                            title=f"Change in {selected_metric} between {first_year} and {second_year}",
+                            zoom=5)
+    fig.update_layout(mapbox_style="carto-positron")
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    st.plotly_chart(fig)
+
+
+    with st.expander("Explanation"):
+        st.write("""
+            Choose two years and an indicator to see which departments changed the most between them. The bar chart and the tables list the largest increases and decreases, and the map shows the change for every department: red for an increase, blue for a decrease.
+                 """)
+
+# ##############################################################################
+
+# Partie 5
+elif selected_chart_section == "Drill-down":
+    st.subheader("Region → department → commune")
+
+    hierarchy = territory_hierarchy()
+    indicator_columns = hierarchy["region"].columns
+    selected_indicator = st.selectbox("Select an indicator", indicator_columns)
+
+# #######################################
+
+    # Niveau 1 : toutes les régions, à partir des agrégats précalculés
+    region_data = hierarchy["region"].xs(selected_year, level='annee_publication')[[selected_indicator]].reset_index()
+    fig = px.bar(region_data.sort_values(selected_indicator), x=selected_indicator, y='nom_region', orientation='h',
+                 title=f'{selected_indicator} by region ({selected_year})')
+    fig.update_yaxes(title=None)
+    st.plotly_chart(fig)
+
+# #######################################
+
+    # Niveau 2 : départements de la région choisie, lus via l'index des enfants
+    selected_region = st.selectbox("Select a region", sorted(hierarchy["children"]))
+    department_codes = list(hierarchy["children"][selected_region])
+    department_data = hierarchy["department"].reindex(
+        pd.MultiIndex.from_product([department_codes, [selected_year]], names=['code_departement', 'annee_publication'])
+    ).reset_index()
+    department_data['nom_departement'] = department_data['code_departement'].map(hierarchy["names"])
+    fig = px.bar(department_data.sort_values(selected_indicator), x=selected_indicator, y='nom_departement', orientation='h',
+                 title=f'{selected_indicator} by department for {selected_region} ({selected_year})')
+    fig.update_yaxes(title=None)
+    st.plotly_chart(fig)
+
+# #######################################
+
+    # Niveau 3 : communes du département choisi, chargées seulement à la demande
+    selected_department = st.selectbox("Select a department", department_codes, format_func=lambda code: hierarchy["names"][code])
+    st.caption(f"{hierarchy['parent'][selected_department]} → {hierarchy['names'][selected_department]}")
+    communes = load_communes(selected_department)
+    if communes is None:
+        st.info(f"No commune-level data is available for {hierarchy['names'][selected_department]}.")
+    else:
+        commune_data = communes[communes['annee_publication'] == selected_year] if 'annee_publication' in communes else communes
+        if selected_indicator in commune_data:
+            fig = px.bar(commune_data.nlargest(30, selected_indicator), x=selected_indicator, y='nom_commune', orientation='h',
+                         title=f'{selected_indicator} by commune for {hierarchy["names"][selected_department]} ({selected_year})')
+            fig.update_yaxes(title=None)
+            st.plotly_chart(fig)
+        else:
+            st.info(f"{selected_indicator} is not available at commune level.")
+
+
+    with st.expander("Explanation"):
+        st.write("""
+            Start from the regions, then choose a region to see its departments, and a department to see its communes. Counts are added up from one level to the next, while rates are averaged and weighted by the number of inhabitants. Commune data is only loaded when you open a department.
+                 """)
+
+# ##############################################################################
+
 # Conclusion
 elif selected_chart_section == "Conclusion":
     
@@ -833,3 +1542,31 @@ elif selected_chart_section == "Conclusion":
 # General conclusion
     st.subheader("General Conclusion")
     st.write("In conclusion, our analysis has enabled us to gain a better understanding of the complex relationships between population, housing, employment, poverty and social housing in different regions of France. These observations are essential for informing public policies and decisions on housing and economic development.")
+
+# ##############################################################################
+
+# Export des données filtrées
+with st.sidebar.expander("Export data"):
+    export_years = st.slider("Export year range", FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
+    export_regions = st.multiselect("Export regions (all if empty)", data['nom_region'].dropna().unique())
+    export_columns = st.multiselect("Export columns", data.columns,
+                                    default=[col for col in data.columns if col != 'geom'])
+    export_format = st.radio("Export format", ["CSV", "Parquet"], horizontal=True)
+
+    # L'export préparé est gardé dans la session : le bouton de téléchargement reste
+    # affiché aux exécutions suivantes, tant que les paramètres ne changent pas
+    export_key = (export_years, tuple(export_regions), tuple(export_columns), export_format)
+    if st.button("Prepare export") and export_columns:
+        st.session_state["export"] = (export_key, write_export(
+            export_chunks(export_columns, export_years, export_regions), export_format))
+
+    if st.session_state.get("export", (None,))[0] == export_key:
+        st.download_button("Download", st.session_state["export"][1],
+                           file_name=f"logements_{export_years[0]}_{export_years[1]}.{export_format.lower()}",
+                           mime="text/csv" if export_format == "CSV" else "application/octet-stream")
+
+# ##############################################################################
+
+# Statistiques du cache (hits / misses / evictions par niveau)
+with st.sidebar.expander("Cache statistics"):
+    st.dataframe(cache_report())